@@ -1,20 +1,33 @@
 import os
+import re
+import json
+import queue
+import atexit
 import base64
-from datetime import datetime
+import threading
+import unicodedata
+from datetime import datetime, timedelta
 from io import BytesIO
 from functools import wraps
+import time
 import pytz # 處理時區
-from flask import Flask, render_template_string, request, redirect, url_for, flash, send_file, session
+from flask import Flask, render_template_string, request, redirect, url_for, flash, send_file, session, jsonify
 from flask_sqlalchemy import SQLAlchemy
+import click
+from sqlalchemy import func, insert, inspect, select, text, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
 import pandas as pd
 
 # 初始化 Flask
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your_super_secret_key'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///school_clubs.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///school_clubs.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 # 設定上傳檔案大小限制 (例如 5MB)
 app.config['MAX_CONTENT_LENGTH'] = 5 * 1024 * 1024
+# 是否啟動背景執行緒，在報名開放/截止前預熱快取 (環境變數 CACHE_WARMUP_ENABLED=0 可關閉)
+app.config['CACHE_WARMUP_ENABLED'] = os.environ.get('CACHE_WARMUP_ENABLED', '1') != '0'
 
 # 管理者帳號設定
 ADMIN_USERNAME = 'admin'
@@ -25,6 +38,28 @@ db = SQLAlchemy(app)
 # 設定台灣時區
 TAIWAN_TZ = pytz.timezone('Asia/Taipei')
 
+# 快取設定
+CACHE_WARMUP_LEAD = timedelta(seconds=30)   # 開放/截止前多久預熱
+CACHE_OPEN_TTL = timedelta(seconds=5)       # 報名期間座位數變動快，快取時間縮短
+CACHE_MAX_TTL = timedelta(minutes=5)        # 任何快取的最長保留時間
+CACHE_SCHEDULER_MAX_SLEEP = 60              # 排程器最長睡眠秒數 (確保會重新讀取社團時間)
+
+# 報名事件紀錄 (批次寫入)
+EVENT_BATCH_SIZE = 200        # 一次最多寫入幾筆
+EVENT_FLUSH_INTERVAL = 1.0    # 最多累積幾秒就寫入
+EVENT_WRITE_RETRIES = 3       # 寫入失敗 (例如 database is locked) 時重試次數
+
+EVENT_APPLIED = 'applied'              # 送出報名
+EVENT_ACCEPTED = 'accepted'            # 正取
+EVENT_WAITLISTED = 'waitlisted'        # 備取
+EVENT_REJECTED_FULL = 'rejected_full'  # 額滿
+EVENT_CONFLICT = 'conflict'            # 衝堂
+EVENT_DUPLICATE = 'duplicate'          # 重複報名
+
+# 報名分析
+ANALYTICS_REFRESH_INTERVAL = timedelta(seconds=10)  # 多久內重複查看直接使用快取
+WEEKDAYS = ['星期一', '星期二', '星期三', '星期四', '星期五', '星期六', '星期日']
+
 def get_taiwan_now():
     """取得目前的台灣時間"""
     return datetime.now(TAIWAN_TZ).replace(tzinfo=None)
@@ -41,6 +76,9 @@ class SystemConfig(db.Model):
     banner_image_data = db.Column(db.Text, nullable=True) 
 
 class Club(db.Model):
+    # 刪除的社團 id 不再重複使用，RegistrationEvent 才不會算到新社團頭上
+    __table_args__ = {'sqlite_autoincrement': True}
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     description = db.Column(db.Text, nullable=True)
@@ -57,22 +95,52 @@ class Club(db.Model):
     class_end = db.Column(db.Time, nullable=False)
     
     registrations = db.relationship('Registration', backref='club', cascade="all, delete-orphan")
+    counter = db.relationship('ClubCounter', uselist=False, cascade="all, delete-orphan")
 
     def current_regular_count(self):
-        return Registration.query.filter_by(club_id=self.id, status='正取').count()
+        return self.counter.regular_count if self.counter else 0
 
     def current_waitlist_count(self):
-        return Registration.query.filter_by(club_id=self.id, status='備取').count()
+        return self.counter.waitlist_count if self.counter else 0
+
+class ClubCounter(db.Model):
+    # 每個社團的正取/備取人數 (可由 RegistrationEvent 重建)
+    club_id = db.Column(db.Integer, db.ForeignKey('club.id'), primary_key=True)
+    regular_count = db.Column(db.Integer, nullable=False, default=0)
+    waitlist_count = db.Column(db.Integer, nullable=False, default=0)
+
+class Student(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    # 正規化後的班級座號 (例如 "60105")，作為學生唯一識別
+    student_key = db.Column(db.String(20), unique=True, nullable=False, index=True)
+    student_name = db.Column(db.String(50), nullable=False)
+    parent_phone = db.Column(db.String(20), nullable=False)
+
+    registrations = db.relationship('Registration', backref='student')
 
 class Registration(db.Model):
+    # 同一位學生同一社團只能有一筆報名
+    __table_args__ = (
+        db.UniqueConstraint('student_id', 'club_id', name='uq_registration_student_club'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     club_id = db.Column(db.Integer, db.ForeignKey('club.id'), nullable=False)
+    student_id = db.Column(db.Integer, db.ForeignKey('student.id'), nullable=True, index=True)
     student_name = db.Column(db.String(50), nullable=False)
     student_class = db.Column(db.String(20), nullable=False)
     parent_phone = db.Column(db.String(20), nullable=False)
     status = db.Column(db.String(10), nullable=False)
     created_at = db.Column(db.DateTime, default=get_taiwan_now)
 
+class RegistrationEvent(db.Model):
+    # 報名事件紀錄，只新增不修改。club_id 不設外鍵，社團刪除後紀錄仍保留
+    id = db.Column(db.Integer, primary_key=True)
+    club_id = db.Column(db.Integer, nullable=False, index=True)
+    student_key = db.Column(db.String(20), nullable=True)
+    event_type = db.Column(db.String(20), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, index=True)
+
 # ==========================================
 # 2. 輔助函式
 # ==========================================
@@ -94,6 +162,135 @@ def get_system_config():
         db.session.commit()
     return conf
 
+CHINESE_DIGITS = {'〇': 0, '零': 0, '一': 1, '二': 2, '三': 3, '四': 4,
+                  '五': 5, '六': 6, '七': 7, '八': 8, '九': 9}
+
+def _chinese_number(match):
+    """把 "五"、"十二"、"二十" 這類中文數字轉成阿拉伯數字 (只支援 0~99)"""
+    text_value = match.group(0)
+    if '十' not in text_value:
+        return ''.join(str(CHINESE_DIGITS[ch]) for ch in text_value)
+    tens, _, ones = text_value.partition('十')
+    if len(tens) > 1 or len(ones) > 1 or '十' in ones:
+        return text_value
+    return str(CHINESE_DIGITS.get(tens, 1) * 10 + CHINESE_DIGITS.get(ones, 0))
+
+def normalize_student_key(raw):
+    """將班級座號正規化 (全形轉半形、中文數字轉阿拉伯數字、去除空白與分隔符號)
+
+    例如 "６０１０５"、"601-05"、"6年1班5號"、"六年一班五號" 都會變成 "60105"。
+    無法辨識 (例如超過三組數字) 時回傳 None。
+    """
+    if not raw:
+        return None
+    value = unicodedata.normalize('NFKC', raw).strip()
+    value = re.sub(r'[〇零一二三四五六七八九十]+', _chinese_number, value)
+    groups = re.findall(r'\d+', value)
+    if not groups or len(groups) > 3:
+        return None
+    if len(groups) == 3:
+        # 年級 / 班級 / 座號
+        grade, cls, seat = groups
+        return f"{int(grade)}{int(cls):02d}{int(seat):02d}"
+    if len(groups) == 2:
+        # 班級代碼 / 座號
+        cls, seat = groups
+        return f"{int(cls)}{int(seat):02d}"
+    return str(int(groups[0]))
+
+def normalize_phone(raw):
+    """只保留電話號碼中的數字"""
+    return re.sub(r'\D', '', unicodedata.normalize('NFKC', raw or ''))
+
+def _same_name(a, b):
+    return re.sub(r'\s', '', unicodedata.normalize('NFKC', a or '')) == re.sub(r'\s', '', unicodedata.normalize('NFKC', b or ''))
+
+def get_or_create_student(student_key, student_name, parent_phone):
+    """依正規化班級座號取得學生，不存在則新增 (不 commit)"""
+    student = Student.query.filter_by(student_key=student_key).first()
+    if student:
+        return student
+    # 同一位新學生同時送出兩次時，第二筆不新增，改讀第一筆建立的資料
+    if db.engine.dialect.name == 'sqlite':
+        # pysqlite 在交易開始前的 SAVEPOINT 會直接 commit，所以改用 ON CONFLICT DO NOTHING
+        db.session.execute(
+            sqlite_insert(Student)
+            .values(student_key=student_key, student_name=student_name, parent_phone=parent_phone)
+            .on_conflict_do_nothing(index_elements=['student_key']))
+    else:
+        try:
+            with db.session.begin_nested():
+                db.session.add(Student(student_key=student_key, student_name=student_name, parent_phone=parent_phone))
+        except IntegrityError:
+            pass
+    return Student.query.filter_by(student_key=student_key).one()
+
+def find_registrations(student_class, parent_phone):
+    """以班級座號 + 家長電話查詢報名紀錄 (依報名時間排序)
+
+    只回傳報名時填寫的家長電話與查詢電話相符的資料，
+    知道班級座號也看不到別人填寫的報名。
+    """
+    student_key = normalize_student_key(student_class)
+    phone = normalize_phone(parent_phone)
+    if not student_key or not phone:
+        return []
+    student = Student.query.filter_by(student_key=student_key).first()
+    if not student:
+        return []
+    regs = (Registration.query
+            .options(db.joinedload(Registration.club))
+            .filter(Registration.student_id == student.id)
+            .order_by(Registration.created_at, Registration.id)
+            .all())
+    return [reg for reg in regs if normalize_phone(reg.parent_phone) == phone]
+
+def count_registrations(club_ids):
+    """直接以 COUNT 計算正取/備取人數 (只用於建立 ClubCounter)"""
+    counts = {club_id: {"regular": 0, "waitlist": 0} for club_id in club_ids}
+    rows = (db.session.query(Registration.club_id, Registration.status, func.count(Registration.id))
+            .filter(Registration.club_id.in_(club_ids))
+            .group_by(Registration.club_id, Registration.status))
+    for club_id, status, count in rows:
+        if status == '正取':
+            counts[club_id]["regular"] = count
+        elif status == '備取':
+            counts[club_id]["waitlist"] = count
+    return counts
+
+def get_club_counter(club_id):
+    counter = db.session.get(ClubCounter, club_id)
+    if counter is None:
+        counts = count_registrations([club_id])[club_id]
+        counter = ClubCounter(club_id=club_id, regular_count=counts["regular"], waitlist_count=counts["waitlist"])
+        db.session.add(counter)
+        db.session.flush()
+    return counter
+
+def claim_seat(club):
+    """以條件式 UPDATE 佔用名額，回傳 ('正取' | '備取' | None, 備取順位)
+
+    判斷與遞增在同一個 UPDATE 完成，同時送出也不會超收；
+    交易 rollback 時名額會一併歸還。
+    """
+    get_club_counter(club.id)
+    result = db.session.execute(
+        update(ClubCounter)
+        .where(ClubCounter.club_id == club.id, ClubCounter.regular_count < club.max_regular)
+        .values(regular_count=ClubCounter.regular_count + 1)
+        .execution_options(synchronize_session=False))
+    if result.rowcount:
+        return '正取', None
+    result = db.session.execute(
+        update(ClubCounter)
+        .where(ClubCounter.club_id == club.id, ClubCounter.waitlist_count < club.max_waitlist)
+        .values(waitlist_count=ClubCounter.waitlist_count + 1)
+        .execution_options(synchronize_session=False))
+    if result.rowcount:
+        position = db.session.scalar(select(ClubCounter.waitlist_count).where(ClubCounter.club_id == club.id))
+        return '備取', position
+    return None, None
+
 def process_image_upload(file_obj):
     """將上傳的檔案轉為 Base64 字串"""
     if file_obj and file_obj.filename != '':
@@ -103,6 +300,404 @@ def process_image_upload(file_obj):
         return b64_str
     return None
 
+# --- 報名時段快取與預熱 ---
+
+class TransitionCache:
+    """記憶體快取，到期時間對齊社團的開放/截止時間
+
+    除了目前的值之外，每個 key 還可以預先放入下一階段的值 (stage)，
+    時間一到 get() 會在同一把鎖內切換過去，不會出現空窗。
+
+    invalidate() 會遞增該 key 的版本 (generation)。讀取資料前先取得版本，
+    寫入時帶入；若中途被 invalidate 過，這筆舊資料就不會寫進快取。
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}      # key -> (value, expires_at)
+        self._staged = {}       # key -> (value, activates_at, expires_at)
+        self._generations = {}  # key -> 版本
+
+    def get(self, key, now):
+        with self._lock:
+            staged = self._staged.get(key)
+            if staged and staged[1] <= now:
+                del self._staged[key]
+                if now < staged[2]:
+                    self._entries[key] = (staged[0], staged[2])
+            entry = self._entries.get(key)
+            if entry and now < entry[1]:
+                return entry[0]
+            self._entries.pop(key, None)
+            return None
+
+    def generation(self, key):
+        with self._lock:
+            return self._generations.get(key, 0)
+
+    def set(self, key, value, expires_at, generation):
+        with self._lock:
+            if generation == self._generations.get(key, 0):
+                self._entries[key] = (value, expires_at)
+
+    def stage(self, key, value, activates_at, expires_at, generation):
+        with self._lock:
+            if generation == self._generations.get(key, 0):
+                self._staged[key] = (value, activates_at, expires_at)
+
+    def is_staged(self, key, activates_at):
+        with self._lock:
+            staged = self._staged.get(key)
+            return bool(staged and staged[1] == activates_at)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._staged.pop(key, None)
+            self._generations[key] = self._generations.get(key, 0) + 1
+
+site_cache = TransitionCache()
+
+def next_transition(club, at):
+    """回傳社團下一次開放或截止的時間點，已截止則回傳 None"""
+    if at < club.start_time:
+        return club.start_time
+    if at <= club.end_time:
+        # 截止時間當下仍可報名，超過才算截止
+        return club.end_time + timedelta(microseconds=1)
+    return None
+
+def seat_cache_expiry(club, at):
+    """座位數快取到期時間：對齊下一次開放/截止，報名期間則只保留 CACHE_OPEN_TTL"""
+    transition = next_transition(club, at)
+    if transition is None:
+        return at + CACHE_MAX_TTL
+    if at < club.start_time:
+        return min(transition, at + CACHE_MAX_TTL)
+    return min(transition, at + CACHE_OPEN_TTL)
+
+def page_cache_expiry(clubs, at):
+    """首頁包含所有社團的座位數，取最早到期的時間"""
+    return min([seat_cache_expiry(club, at) for club in clubs], default=at + CACHE_MAX_TTL)
+
+def load_config_snapshot():
+    conf = get_system_config()
+    return {
+        "site_title": conf.site_title,
+        "welcome_msg": conf.welcome_msg,
+        "banner_image_data": conf.banner_image_data,
+    }
+
+def get_cached_config():
+    now = get_taiwan_now()
+    conf = site_cache.get('config', now)
+    if conf is None:
+        generation = site_cache.generation('config')
+        conf = load_config_snapshot()
+        site_cache.set('config', conf, now + CACHE_MAX_TTL, generation)
+    return conf
+
+def load_seat_counts(club_ids):
+    """一次讀取多個社團的正取/備取人數 (ClubCounter)"""
+    counts = {club_id: {"regular": 0, "waitlist": 0} for club_id in club_ids}
+    for counter in ClubCounter.query.filter(ClubCounter.club_id.in_(club_ids)):
+        counts[counter.club_id] = {"regular": counter.regular_count, "waitlist": counter.waitlist_count}
+    return counts
+
+def get_seat_counts(clubs, now):
+    """取得座位數 (優先使用快取，未命中的社團合併成一次查詢)"""
+    seats = {}
+    missing = []
+    for club in clubs:
+        cached = site_cache.get(('seats', club.id), now)
+        if cached is None:
+            missing.append(club)
+        else:
+            seats[club.id] = cached
+    if missing:
+        generations = {club.id: site_cache.generation(('seats', club.id)) for club in missing}
+        loaded = load_seat_counts([club.id for club in missing])
+        for club in missing:
+            site_cache.set(('seats', club.id), loaded[club.id], seat_cache_expiry(club, now), generations[club.id])
+            seats[club.id] = loaded[club.id]
+    return seats
+
+def invalidate_club_cache(club_id=None):
+    """報名或社團資料異動後清除相關快取"""
+    if club_id is not None:
+        site_cache.invalidate(('seats', club_id))
+    site_cache.invalidate('page:index')
+
+def render_home_page(clubs, now):
+    seats = get_seat_counts(clubs, now)
+    return render_template_string(HOME_TEMPLATE, clubs=clubs, seats=seats)
+
+def warm_upcoming_transitions(now):
+    """為即將開放/截止的社團預先計算座位數與首頁，回傳距離下一次需要預熱的秒數"""
+    clubs = Club.query.order_by(Club.weekday, Club.class_start).all()
+    next_wake = now + timedelta(seconds=CACHE_SCHEDULER_MAX_SLEEP)
+    due = []
+    for club in clubs:
+        transition = next_transition(club, now)
+        if transition is None:
+            continue
+        if transition - CACHE_WARMUP_LEAD <= now:
+            due.append((club, transition))
+            # 切換後再醒來一次，處理同一段時間內的下一個切換點
+            next_wake = min(next_wake, transition)
+        else:
+            next_wake = min(next_wake, transition - CACHE_WARMUP_LEAD)
+
+    if due:
+        # 先取得版本再讀資料，期間若有人報名 (invalidate)，舊資料就不會被放進快取
+        generation = site_cache.generation('config')
+        site_cache.set('config', load_config_snapshot(), now + CACHE_MAX_TTL, generation)
+        pending = [(club, t) for club, t in due if not site_cache.is_staged(('seats', club.id), t)]
+        if pending:
+            generations = {club.id: site_cache.generation(('seats', club.id)) for club, _ in pending}
+            counts = load_seat_counts([club.id for club, _ in pending])
+            for club, transition in pending:
+                site_cache.stage(('seats', club.id), counts[club.id], transition,
+                                 seat_cache_expiry(club, transition), generations[club.id])
+        first_transition = min(t for _, t in due)
+        if not site_cache.is_staged('page:index', first_transition):
+            generation = site_cache.generation('page:index')
+            with app.test_request_context('/'):
+                html = render_home_page(clubs, now)
+            site_cache.stage('page:index', html, first_transition, page_cache_expiry(clubs, first_transition),
+                             generation)
+
+    return (next_wake - now).total_seconds()
+
+class WarmupScheduler:
+    """背景執行緒：在社團開放/截止前 CACHE_WARMUP_LEAD 預熱快取"""
+    def __init__(self):
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='cache-warmup', daemon=True)
+            self._thread.start()
+
+    def notify(self):
+        """社團時間被修改時叫醒排程器重新計算"""
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            delay = CACHE_SCHEDULER_MAX_SLEEP
+            with app.app_context():
+                try:
+                    delay = warm_upcoming_transitions(get_taiwan_now())
+                except Exception:
+                    app.logger.exception('快取預熱失敗')
+            self._wake.wait(max(delay, 1))
+            self._wake.clear()
+
+warmup_scheduler = WarmupScheduler()
+
+# --- 報名事件紀錄 ---
+
+class EventLogWriter:
+    """診斷用的報名事件 (applied / rejected_full / conflict / duplicate) 先放進佇列，
+    由背景執行緒批次寫入，不佔用報名請求的時間
+
+    accepted / waitlisted 會影響 ClubCounter 的重建，不經過這裡，
+    而是和 Registration 在同一個交易寫入 (見 register_student)。
+    """
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def log(self, club_id, event_type, student_key=None):
+        # 事件時間在發生當下記錄，而不是寫入資料庫的時間
+        self._queue.put({
+            "club_id": club_id,
+            "student_key": student_key,
+            "event_type": event_type,
+            "created_at": get_taiwan_now(),
+        })
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='event-log-writer', daemon=True)
+            self._thread.start()
+
+    def flush(self):
+        """立即寫入佇列中所有事件"""
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+            if len(batch) >= EVENT_BATCH_SIZE:
+                self._write(batch)
+                batch = []
+        if batch:
+            self._write(batch)
+
+    def _write(self, batch):
+        with app.app_context():
+            for attempt in range(1, EVENT_WRITE_RETRIES + 1):
+                try:
+                    db.session.execute(insert(RegistrationEvent), batch)
+                    db.session.commit()
+                    return
+                except Exception:
+                    db.session.rollback()
+                    if attempt == EVENT_WRITE_RETRIES:
+                        app.logger.exception('報名事件寫入失敗，遺失 %d 筆', len(batch))
+                    else:
+                        time.sleep(0.5 * attempt)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + EVENT_FLUSH_INTERVAL
+            while len(batch) < EVENT_BATCH_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+event_log = EventLogWriter()
+atexit.register(event_log.flush)
+
+def replay_events(until=None):
+    """依事件紀錄重建指定時間點 (含) 的報名狀態
+
+    回傳 {club_id: {"regular": [...], "waitlist": [...], "<event_type>": 次數}}，
+    regular / waitlist 為依報名順序排列的班級座號。
+    """
+    query = RegistrationEvent.query
+    if until is not None:
+        query = query.filter(RegistrationEvent.created_at <= until)
+    state = {}
+    for event in query.order_by(RegistrationEvent.created_at, RegistrationEvent.id):
+        club_state = state.setdefault(event.club_id, {"regular": [], "waitlist": []})
+        club_state[event.event_type] = club_state.get(event.event_type, 0) + 1
+        if event.event_type == EVENT_ACCEPTED:
+            club_state["regular"].append(event.student_key)
+        elif event.event_type == EVENT_WAITLISTED:
+            club_state["waitlist"].append(event.student_key)
+    return state
+
+def rebuild_club_counters():
+    """由事件紀錄重算所有社團的 ClubCounter"""
+    state = replay_events()
+    for club in Club.query.all():
+        counter = db.session.get(ClubCounter, club.id) or ClubCounter(club_id=club.id)
+        club_state = state.get(club.id, {"regular": [], "waitlist": []})
+        counter.regular_count = len(club_state["regular"])
+        counter.waitlist_count = len(club_state["waitlist"])
+        db.session.add(counter)
+    db.session.commit()
+
+# --- 報名分析 ---
+
+ANALYTICS_EVENT_TYPES = [EVENT_APPLIED, EVENT_ACCEPTED, EVENT_WAITLISTED,
+                         EVENT_REJECTED_FULL, EVENT_CONFLICT, EVENT_DUPLICATE]
+
+class RegistrationAnalytics:
+    """各社團報名統計
+
+    每次更新只用一個查詢取出社團資料與「上次之後」的新事件，
+    以 pandas 累加到既有的統計上，不會每次從頭重算。
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset_state()
+
+    def _reset_state(self):
+        self._watermark = 0
+        self._totals = pd.DataFrame(columns=ANALYTICS_EVENT_TYPES, dtype='int64')
+        self._full_at = pd.Series(dtype='datetime64[ns]')
+        self._result = None
+        self._refreshed_at = None
+
+    def reset(self):
+        """社團名額等設定被修改後，從頭重新累計"""
+        with self._lock:
+            self._reset_state()
+
+    def get(self, now):
+        with self._lock:
+            if self._result is None or now - self._refreshed_at >= ANALYTICS_REFRESH_INTERVAL:
+                self._refresh(now)
+            return self._result
+
+    def _refresh(self, now):
+        # 增量累計依賴「id 較大的事件不會比 id 較小的事件先 commit」：
+        # SQLite 同一時間只有一個寫入者，id 依 commit 順序遞增，所以只要讀 id > watermark 就不會漏。
+        # 換成可多個交易同時寫入的資料庫 (例如 PostgreSQL) 時，較小的 id 可能晚於 watermark 才 commit
+        # 而被永遠跳過，必須重新設計 watermark (例如改用 commit 時間並保留重疊區間)。
+        stmt = (select(Club.id.label('club_id'), Club.name, Club.weekday, Club.class_start, Club.start_time,
+                       Club.max_regular, Club.max_waitlist, RegistrationEvent.id.label('event_id'),
+                       RegistrationEvent.event_type, RegistrationEvent.created_at)
+                .outerjoin(RegistrationEvent, (RegistrationEvent.club_id == Club.id)
+                           & (RegistrationEvent.id > self._watermark)))
+        df = pd.read_sql(stmt, db.session.connection())
+        clubs = df.drop_duplicates('club_id').set_index('club_id')[
+            ['name', 'weekday', 'class_start', 'start_time', 'max_regular', 'max_waitlist']]
+        events = df.dropna(subset=['event_id'])
+        if not events.empty:
+            self._fold(events)
+            self._watermark = int(events['event_id'].max())
+        self._result = self._summarize(clubs, now)
+        self._refreshed_at = now
+
+    def _fold(self, events):
+        """把新事件累加進各社團統計，並找出正取額滿的時間點"""
+        events = events.assign(created_at=pd.to_datetime(events['created_at']))
+        tallies = (pd.crosstab(events['club_id'], events['event_type'])
+                   .reindex(columns=ANALYTICS_EVENT_TYPES, fill_value=0))
+
+        accepted = events[events['event_type'] == EVENT_ACCEPTED].sort_values('event_id')
+        if not accepted.empty:
+            prior = self._totals['accepted'].reindex(accepted['club_id']).fillna(0).to_numpy()
+            seq = accepted.groupby('club_id').cumcount().to_numpy() + 1 + prior
+            filled = accepted[seq == accepted['max_regular'].to_numpy()]
+            self._full_at = self._full_at.combine_first(filled.groupby('club_id')['created_at'].min())
+
+        self._totals = self._totals.add(tallies, fill_value=0).astype('int64')
+
+    def _summarize(self, clubs, now):
+        stats = clubs.join(self._totals, how='left')
+        stats[ANALYTICS_EVENT_TYPES] = stats[ANALYTICS_EVENT_TYPES].fillna(0).astype('int64')
+        stats['start_time'] = pd.to_datetime(stats['start_time'])
+        stats['full_at'] = self._full_at.reindex(stats.index)
+        stats['capacity'] = stats['max_regular'] + stats['max_waitlist']
+        stats['fill_rate'] = (stats['accepted'] / stats['max_regular'].where(stats['max_regular'] > 0)).clip(upper=1).round(3)
+        stats['time_to_full_seconds'] = (stats['full_at'] - stats['start_time']).dt.total_seconds()
+        stats['waitlist_depth'] = stats['waitlisted']
+        stats['time_slot'] = stats['class_start'].astype(str).str[:5]
+        stats = stats.sort_values(['time_to_full_seconds', 'fill_rate'], ascending=[True, False], na_position='last')
+
+        demand = (stats.groupby(['weekday', 'time_slot'], as_index=False)
+                  .agg(clubs=('name', 'size'), capacity=('capacity', 'sum'), applied=('applied', 'sum'),
+                       accepted=('accepted', 'sum'), waitlisted=('waitlisted', 'sum'),
+                       rejected_full=('rejected_full', 'sum')))
+        demand['demand_ratio'] = (demand['applied'] / demand['capacity'].where(demand['capacity'] > 0)).round(2)
+        demand['weekday'] = pd.Categorical(demand['weekday'], categories=WEEKDAYS, ordered=True)
+        demand = demand.sort_values(['weekday', 'time_slot'])
+        demand['weekday'] = demand['weekday'].astype(str)
+
+        stats['full_at'] = stats['full_at'].dt.strftime('%Y-%m-%d %H:%M:%S')
+        club_columns = ['name', 'weekday', 'time_slot', 'max_regular', 'max_waitlist', 'fill_rate',
+                        'time_to_full_seconds', 'full_at', 'waitlist_depth'] + ANALYTICS_EVENT_TYPES
+        return {
+            "generated_at": now.strftime('%Y-%m-%d %H:%M:%S'),
+            "clubs": json.loads(stats.reset_index()[['club_id'] + club_columns].to_json(orient='records')),
+            "demand": json.loads(demand.to_json(orient='records')),
+        }
+
+registration_analytics = RegistrationAnalytics()
+
 # ==========================================
 # 3. HTML 模板 (加入活潑設計)
 # ==========================================
@@ -164,6 +759,7 @@ BASE_LAYOUT = """
         <div class="container">
             <a class="navbar-brand" href="/">🏫 {{ config.site_title }}</a>
             <div class="ms-auto">
+                <a href="/my" class="btn btn-light btn-sm fw-bold text-primary me-2">📋 我的報名</a>
                 {% if session.get('logged_in') %}
                     <a href="/admin" class="btn btn-warning btn-sm fw-bold shadow-sm">⚙️ 管理後台</a>
                     <a href="/logout" class="btn btn-light btn-sm ms-2 text-primary fw-bold">登出</a>
@@ -251,12 +847,12 @@ HOME_TEMPLATE = BASE_LAYOUT.replace("{% block content %}{% endblock %}", """
                 </p>
                 <div class="d-flex justify-content-between text-center my-3 p-2 rounded bg-light border">
                     <div>
-                        <span class="d-block fw-bold text-success fs-5">{{ club.current_regular_count() }}/{{ club.max_regular }}</span>
+                        <span class="d-block fw-bold text-success fs-5">{{ seats[club.id].regular }}/{{ club.max_regular }}</span>
                         <small class="text-muted">正取名額</small>
                     </div>
                     <div class="border-start"></div>
                     <div>
-                        <span class="d-block fw-bold text-secondary fs-5">{{ club.current_waitlist_count() }}/{{ club.max_waitlist }}</span>
+                        <span class="d-block fw-bold text-secondary fs-5">{{ seats[club.id].waitlist }}/{{ club.max_waitlist }}</span>
                         <small class="text-muted">備取名額</small>
                     </div>
                 </div>
@@ -334,10 +930,70 @@ CLUB_DETAIL_TEMPLATE = BASE_LAYOUT.replace("{% block content %}{% endblock %}",
 </div>
 """)
 
+MY_REGISTRATIONS_TEMPLATE = BASE_LAYOUT.replace("{% block content %}{% endblock %}", """
+<div class="row justify-content-center">
+    <div class="col-lg-8">
+        <div class="card p-4 mb-4">
+            <h3 class="fw-bold text-primary mb-3">📋 查詢我的報名</h3>
+            <form method="GET" class="row g-2">
+                <div class="col-md-5">
+                    <input type="text" name="student_class" class="form-control rounded-pill" value="{{ student_class }}" required placeholder="班級座號，例如：60105">
+                </div>
+                <div class="col-md-5">
+                    <input type="tel" name="parent_phone" class="form-control rounded-pill" value="{{ parent_phone }}" required placeholder="報名時填寫的家長電話">
+                </div>
+                <div class="col-md-2">
+                    <button type="submit" class="btn btn-primary w-100">查詢</button>
+                </div>
+            </form>
+        </div>
+
+        {% if searched %}
+            {% if registrations %}
+            <div class="card p-0 overflow-hidden shadow">
+                <div class="card-header bg-primary text-white fw-bold py-3">
+                    {{ registrations[0].student_name }} ({{ student_key }}) 的報名紀錄
+                </div>
+                <table class="table table-hover mb-0 align-middle">
+                    <thead>
+                        <tr>
+                            <th class="ps-4">社團名稱</th>
+                            <th>上課時間</th>
+                            <th>報名狀態</th>
+                            <th>報名時間</th>
+                        </tr>
+                    </thead>
+                    <tbody>
+                        {% for reg in registrations %}
+                        <tr>
+                            <td class="ps-4 fw-bold"><a href="/club/{{ reg.club.id }}">{{ reg.club.name }}</a></td>
+                            <td><span class="badge bg-light text-dark border">{{ reg.club.weekday }} {{ reg.club.class_start.strftime('%H:%M') }} - {{ reg.club.class_end.strftime('%H:%M') }}</span></td>
+                            <td>
+                                {% if reg.status == '正取' %}
+                                    <span class="badge bg-success">正取</span>
+                                {% else %}
+                                    <span class="badge bg-secondary">{{ reg.status }}</span>
+                                {% endif %}
+                            </td>
+                            <td class="text-muted small">{{ reg.created_at.strftime('%Y-%m-%d %H:%M') }}</td>
+                        </tr>
+                        {% endfor %}
+                    </tbody>
+                </table>
+            </div>
+            {% else %}
+            <div class="text-center text-muted py-4">查無資料，請確認班級座號與家長電話是否正確。</div>
+            {% endif %}
+        {% endif %}
+    </div>
+</div>
+""")
+
 ADMIN_DASHBOARD_TEMPLATE = BASE_LAYOUT.replace("{% block content %}{% endblock %}", """
 <div class="d-flex justify-content-between align-items-center mb-4">
     <h2 class="fw-bold text-dark">⚙️ 管理者後台</h2>
     <div>
+        <a href="/admin/analytics" class="btn btn-primary fw-bold me-2 shadow-sm">📊 報名分析</a>
         <a href="/admin/config" class="btn btn-info text-white fw-bold me-2 shadow-sm">🏠 設定首頁</a>
         <a href="/admin/create" class="btn btn-success fw-bold shadow-sm">+ 新增社團</a>
     </div>
@@ -375,6 +1031,88 @@ ADMIN_DASHBOARD_TEMPLATE = BASE_LAYOUT.replace("{% block content %}{% endblock %
 </div>
 """)
 
+ADMIN_ANALYTICS_TEMPLATE = BASE_LAYOUT.replace("{% block content %}{% endblock %}", """
+<div class="d-flex justify-content-between align-items-center mb-4">
+    <h2 class="fw-bold text-dark">📊 報名分析</h2>
+    <div>
+        <small class="text-muted me-2">更新時間：{{ analytics.generated_at }}</small>
+        <a href="/admin" class="btn btn-secondary fw-bold shadow-sm">返回</a>
+    </div>
+</div>
+
+<h5 class="fw-bold text-primary mb-3">各社團報名狀況 (依額滿速度排序)</h5>
+<div class="card p-0 overflow-hidden shadow mb-5">
+    <table class="table table-hover mb-0 align-middle">
+        <thead class="bg-dark text-white">
+            <tr>
+                <th class="py-3 ps-4">社團名稱</th>
+                <th>上課時間</th>
+                <th>正取填滿率</th>
+                <th>額滿耗時</th>
+                <th>備取人數</th>
+                <th>報名次數</th>
+                <th>額滿被拒</th>
+                <th class="pe-4">衝堂 / 重複</th>
+            </tr>
+        </thead>
+        <tbody>
+            {% for c in analytics.clubs %}
+            <tr>
+                <td class="ps-4 fw-bold">{{ c.name }}</td>
+                <td><span class="badge bg-light text-dark border">{{ c.weekday }} {{ c.time_slot }}</span></td>
+                <td>{{ '%.0f' | format(c.fill_rate * 100) ~ '%' if c.fill_rate is not none else '-' }}</td>
+                <td>
+                    {% if c.time_to_full_seconds is none %}
+                        <span class="text-muted">未額滿</span>
+                    {% elif c.time_to_full_seconds < 60 %}
+                        <span class="text-danger fw-bold">{{ '%.0f' | format(c.time_to_full_seconds) }} 秒</span>
+                    {% else %}
+                        {{ '%.1f' | format(c.time_to_full_seconds / 60) }} 分鐘
+                    {% endif %}
+                </td>
+                <td>{{ c.waitlist_depth }}/{{ c.max_waitlist }}</td>
+                <td>{{ c.applied }}</td>
+                <td class="text-danger">{{ c.rejected_full }}</td>
+                <td class="pe-4 text-muted">{{ c.conflict }} / {{ c.duplicate }}</td>
+            </tr>
+            {% else %}
+            <tr><td colspan="8" class="text-center text-muted py-4">目前沒有社團</td></tr>
+            {% endfor %}
+        </tbody>
+    </table>
+</div>
+
+<h5 class="fw-bold text-primary mb-3">各上課時段需求</h5>
+<div class="card p-0 overflow-hidden shadow">
+    <table class="table table-hover mb-0 align-middle">
+        <thead class="bg-dark text-white">
+            <tr>
+                <th class="py-3 ps-4">上課時段</th>
+                <th>社團數</th>
+                <th>總名額 (正+備)</th>
+                <th>報名次數</th>
+                <th>正取 / 備取</th>
+                <th>額滿被拒</th>
+                <th class="pe-4">需求倍數</th>
+            </tr>
+        </thead>
+        <tbody>
+            {% for d in analytics.demand %}
+            <tr>
+                <td class="ps-4 fw-bold">{{ d.weekday }} {{ d.time_slot }}</td>
+                <td>{{ d.clubs }}</td>
+                <td>{{ d.capacity }}</td>
+                <td>{{ d.applied }}</td>
+                <td>{{ d.accepted }} / {{ d.waitlisted }}</td>
+                <td class="text-danger">{{ d.rejected_full }}</td>
+                <td class="pe-4">{{ d.demand_ratio if d.demand_ratio is not none else '-' }}</td>
+            </tr>
+            {% endfor %}
+        </tbody>
+    </table>
+</div>
+""")
+
 # 表單共用模板 (新增/編輯)
 FORM_TEMPLATE_CONTENT = """
 <h2 class="mb-4 fw-bold">{{ title }}</h2>
@@ -490,9 +1228,26 @@ ADMIN_CONFIG_TEMPLATE = BASE_LAYOUT.replace("{% block content %}{% endblock %}",
 # 4. 路由與邏輯
 # ==========================================
 
+_workers_lock = threading.Lock()
+_workers_started = False
+
+@app.before_request
+def start_background_workers():
+    """收到第一個請求時才啟動背景執行緒，flask CLI 指令 (rebuild-counters 等) 不會啟動"""
+    global _workers_started
+    # 啟動後每個請求只檢查旗標，不再搶鎖
+    if _workers_started:
+        return
+    with _workers_lock:
+        if not _workers_started:
+            event_log.start()
+            if app.config['CACHE_WARMUP_ENABLED']:
+                warmup_scheduler.start()
+            _workers_started = True
+
 @app.context_processor
 def inject_config():
-    return dict(config=get_system_config())
+    return dict(config=get_cached_config())
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -513,8 +1268,17 @@ def logout():
 
 @app.route('/')
 def index():
-    clubs = Club.query.order_by(Club.weekday, Club.class_start).all()
-    return render_template_string(HOME_TEMPLATE, clubs=clubs)
+    now = get_taiwan_now()
+    # 登入中或有提示訊息時頁面內容因人而異，不使用快取
+    personalized = session.get('logged_in') or '_flashes' in session
+    html = None if personalized else site_cache.get('page:index', now)
+    if html is None:
+        generation = site_cache.generation('page:index')
+        clubs = Club.query.order_by(Club.weekday, Club.class_start).all()
+        html = render_home_page(clubs, now)
+        if not personalized:
+            site_cache.set('page:index', html, page_cache_expiry(clubs, now), generation)
+    return html
 
 @app.route('/club/<int:club_id>')
 def club_detail(club_id):
@@ -533,9 +1297,8 @@ def club_detail(club_id):
         can_register = False
         status_message = "報名已截止"
     else:
-        reg_count = club.current_regular_count()
-        wait_count = club.current_waitlist_count()
-        if reg_count >= club.max_regular and wait_count >= club.max_waitlist:
+        seats = get_seat_counts([club], now)[club.id]
+        if seats["regular"] >= club.max_regular and seats["waitlist"] >= club.max_waitlist:
             can_register = False
             status_message = "名額已額滿"
 
@@ -554,45 +1317,105 @@ def register_student(club_id):
     student_class = request.form.get('student_class')
     parent_phone = request.form.get('parent_phone')
 
+    student_key = normalize_student_key(student_class)
+    if not student_key:
+        flash('班級座號格式錯誤，請輸入例如：60105', 'danger')
+        return redirect(url_for('club_detail', club_id=club_id))
+    student = get_or_create_student(student_key, student_name, parent_phone)
+    event_log.log(club.id, EVENT_APPLIED, student_key)
+
+    # 班級座號已屬於另一位學生時不合併，避免重複/衝堂檢查與查詢套到別人的孩子
+    if not _same_name(student.student_name, student_name):
+        db.session.rollback()
+        event_log.log(club.id, EVENT_CONFLICT, student_key)
+        flash('❌ 報名失敗！此班級座號已由其他姓名的學生報名，請確認班級座號是否正確，或洽學校處理。', 'danger')
+        return redirect(url_for('club_detail', club_id=club_id))
+    if normalize_phone(student.parent_phone) != normalize_phone(parent_phone):
+        app.logger.warning('班級座號 %s 的家長電話與先前不同 (%s / %s)', student_key, student.parent_phone, parent_phone)
+
     # 重複報名檢查
-    existing = Registration.query.filter_by(club_id=club_id, student_class=student_class).first()
+    existing = Registration.query.filter_by(student_id=student.id, club_id=club_id).first()
     if existing:
+        event_log.log(club.id, EVENT_DUPLICATE, student_key)
         flash('您已經報名過此社團了！', 'warning')
         return redirect(url_for('club_detail', club_id=club_id))
 
-    # 衝堂檢查
-    student_regs = Registration.query.filter_by(student_class=student_class).all()
-    for reg in student_regs:
-        existing_club = reg.club
-        if existing_club.weekday == club.weekday:
-            if (club.class_start < existing_club.class_end) and (club.class_end > existing_club.class_start):
-                flash(f'❌ 報名失敗！與已報名的【{existing_club.name}】上課時間衝突。', 'danger')
-                return redirect(url_for('club_detail', club_id=club_id))
+    # 衝堂檢查 (只查同一天且時段重疊的已報名社團)
+    conflict = (Registration.query.join(Club)
+                .filter(Registration.student_id == student.id,
+                        Club.weekday == club.weekday,
+                        Club.class_start < club.class_end,
+                        Club.class_end > club.class_start)
+                .first())
+    if conflict:
+        event_log.log(club.id, EVENT_CONFLICT, student_key)
+        flash(f'❌ 報名失敗！與已報名的【{conflict.club.name}】上課時間衝突。', 'danger')
+        return redirect(url_for('club_detail', club_id=club_id))
 
     # 正取/備取判定
-    status = None
-    current_reg = club.current_regular_count()
-    current_wait = club.current_waitlist_count()
-
-    if current_reg < club.max_regular:
-        status = '正取'
-        flash(f'✅ 報名成功！恭喜 {student_name} 為【正取】。', 'success')
-    elif current_wait < club.max_waitlist:
-        status = '備取'
-        flash(f'⚠️ 報名成功，但正取已滿。{student_name} 列為【備取第 {current_wait + 1} 順位】。', 'warning')
-    else:
+    status, waitlist_position = claim_seat(club)
+    if status is None:
+        db.session.rollback()
+        event_log.log(club.id, EVENT_REJECTED_FULL, student_key)
         flash('❌ 很抱歉，本社團已全數額滿。', 'danger')
         return redirect(url_for('club_detail', club_id=club_id))
 
     new_reg = Registration(
-        club_id=club.id, student_name=student_name,
+        club_id=club.id, student_id=student.id, student_name=student_name,
         student_class=student_class, parent_phone=parent_phone, status=status
     )
     db.session.add(new_reg)
-    db.session.commit()
+    # 正取/備取事件與報名資料同一個交易寫入，重建 ClubCounter 時才不會少算
+    db.session.add(RegistrationEvent(
+        club_id=club.id, student_key=student_key, created_at=get_taiwan_now(),
+        event_type=EVENT_ACCEPTED if status == '正取' else EVENT_WAITLISTED))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # 同時送出兩次報名時，由唯一索引擋下第二筆
+        db.session.rollback()
+        event_log.log(club.id, EVENT_DUPLICATE, student_key)
+        flash('您已經報名過此社團了！', 'warning')
+        return redirect(url_for('club_detail', club_id=club_id))
+    invalidate_club_cache(club.id)
+
+    if status == '正取':
+        flash(f'✅ 報名成功！恭喜 {student_name} 為【正取】。', 'success')
+    else:
+        flash(f'⚠️ 報名成功，但正取已滿。{student_name} 列為【備取第 {waitlist_position} 順位】。', 'warning')
 
     return redirect(url_for('club_detail', club_id=club_id))
 
+@app.route('/my')
+def my_registrations():
+    student_class = request.args.get('student_class', '')
+    parent_phone = request.args.get('parent_phone', '')
+    searched = bool(student_class and parent_phone)
+    registrations = find_registrations(student_class, parent_phone) if searched else []
+    return render_template_string(MY_REGISTRATIONS_TEMPLATE, searched=searched, registrations=registrations,
+                                  student_key=normalize_student_key(student_class),
+                                  student_class=student_class, parent_phone=parent_phone)
+
+@app.route('/api/my-registrations')
+def api_my_registrations():
+    student_class = request.args.get('student_class')
+    registrations = find_registrations(student_class, request.args.get('parent_phone'))
+    if not registrations:
+        return jsonify(error='查無資料，請確認班級座號與家長電話是否正確。'), 404
+    return jsonify(
+        student_key=normalize_student_key(student_class),
+        student_name=registrations[0].student_name,
+        registrations=[{
+            "club_id": r.club.id,
+            "club_name": r.club.name,
+            "weekday": r.club.weekday,
+            "class_start": r.club.class_start.strftime('%H:%M'),
+            "class_end": r.club.class_end.strftime('%H:%M'),
+            "status": r.status,
+            "created_at": r.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+        } for r in registrations]
+    )
+
 # --- 管理者後台 ---
 
 @app.route('/admin')
@@ -616,6 +1439,8 @@ def admin_config():
             conf.banner_image_data = b64_img
             
         db.session.commit()
+        site_cache.invalidate('config')
+        invalidate_club_cache()
         flash('網站設定已更新', 'success')
         return redirect(url_for('admin_config'))
     return render_template_string(ADMIN_CONFIG_TEMPLATE)
@@ -641,10 +1466,14 @@ def admin_create():
                 max_waitlist=int(request.form.get('max_waitlist')),
                 weekday=request.form.get('weekday'),
                 class_start=c_start,
-                class_end=c_end
+                class_end=c_end,
+                counter=ClubCounter()
             )
             db.session.add(new_club)
             db.session.commit()
+            invalidate_club_cache()
+            warmup_scheduler.notify()
+            registration_analytics.reset()
             flash('社團新增成功！', 'success')
             return redirect(url_for('admin_dashboard'))
         except Exception as e:
@@ -676,6 +1505,9 @@ def admin_edit(club_id):
                 club.image_data = new_img
                 
             db.session.commit()
+            invalidate_club_cache(club.id)
+            warmup_scheduler.notify()
+            registration_analytics.reset()
             flash('社團修改成功！', 'success')
             return redirect(url_for('admin_dashboard'))
         except Exception as e:
@@ -689,6 +1521,9 @@ def admin_delete(club_id):
     club = Club.query.get_or_404(club_id)
     db.session.delete(club)
     db.session.commit()
+    invalidate_club_cache(club_id)
+    warmup_scheduler.notify()
+    registration_analytics.reset()
     flash('社團已刪除', 'success')
     return redirect(url_for('admin_dashboard'))
 
@@ -722,9 +1557,153 @@ def admin_export(club_id):
     output.seek(0)
     return send_file(output, as_attachment=True, download_name=f"{club.name}_名單.xlsx")
 
+@app.route('/admin/analytics')
+@login_required
+def admin_analytics():
+    analytics = registration_analytics.get(get_taiwan_now())
+    return render_template_string(ADMIN_ANALYTICS_TEMPLATE, analytics=analytics)
+
+@app.route('/api/admin/analytics')
+@login_required
+def api_admin_analytics():
+    return jsonify(registration_analytics.get(get_taiwan_now()))
+
+def upgrade_schema():
+    """舊資料庫補上 registration.student_id 欄位與索引 (create_all 不會修改既有資料表)"""
+    columns = [c['name'] for c in inspect(db.engine).get_columns('registration')]
+    if 'student_id' in columns:
+        return
+    db.session.execute(text('ALTER TABLE registration ADD COLUMN student_id INTEGER REFERENCES student (id)'))
+    db.session.execute(text('CREATE INDEX ix_registration_student_id ON registration (student_id)'))
+    # student_id 尚未回填時皆為 NULL，不會違反唯一索引
+    db.session.execute(text('CREATE UNIQUE INDEX uq_registration_student_club ON registration (student_id, club_id)'))
+    db.session.commit()
+
+def upgrade_club_autoincrement():
+    """舊資料庫的 club 資料表改用 AUTOINCREMENT，並跳過事件紀錄中用過的 club_id"""
+    if db.engine.dialect.name != 'sqlite':
+        return
+    table_sql = db.session.execute(
+        text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'club'")).scalar()
+    if 'AUTOINCREMENT' not in table_sql.upper():
+        # SQLite 無法直接修改，依官方建議建立新表、複製資料後改名
+        columns = ', '.join(column.name for column in Club.__table__.columns)
+        Club.__table__.to_metadata(db.MetaData(), name='club_new').create(db.session.connection())
+        db.session.execute(text(f'INSERT INTO club_new ({columns}) SELECT {columns} FROM club'))
+        db.session.execute(text('DROP TABLE club'))
+        db.session.execute(text('ALTER TABLE club_new RENAME TO club'))
+    # 已刪除社團的 id 若大於目前最大值，也要跳過
+    used = db.session.scalar(select(func.max(RegistrationEvent.club_id)))
+    if used:
+        seq = db.session.execute(text("SELECT seq FROM sqlite_sequence WHERE name = 'club'")).scalar()
+        if seq is None:
+            db.session.execute(text("INSERT INTO sqlite_sequence (name, seq) VALUES ('club', :seq)"), {'seq': used})
+        elif seq < used:
+            db.session.execute(text("UPDATE sqlite_sequence SET seq = :seq WHERE name = 'club'"), {'seq': used})
+    db.session.commit()
+
+def _describe_registration(reg):
+    return (f"#{reg.id} 社團={reg.club_id} 班級座號={reg.student_class!r} 姓名={reg.student_name!r} "
+            f"電話={reg.parent_phone!r} 狀態={reg.status} 報名時間={reg.created_at}")
+
+def backfill_students():
+    """將尚未連結學生的舊報名資料依正規化班級座號歸戶
+
+    - 班級座號無法辨識，或與既有學生姓名不同的資料不歸戶 (保留 student_id 為 NULL，需人工確認)
+    - 班級座號與姓名都相同、又報名同一社團的重複資料才刪除，保留最早的一筆
+    每一筆未歸戶或刪除的資料都會寫進 log。
+    """
+    regs = (Registration.query.filter(Registration.student_id.is_(None))
+            .order_by(Registration.created_at, Registration.id).all())
+    if not regs:
+        return
+    students = {s.student_key: s for s in Student.query.all()}
+    seen = {(r.student_id, r.club_id) for r in Registration.query.filter(Registration.student_id.isnot(None))}
+    for reg in regs:
+        student_key = normalize_student_key(reg.student_class)
+        if not student_key:
+            app.logger.warning('舊報名資料未歸戶 (班級座號無法辨識)：%s', _describe_registration(reg))
+            continue
+        student = students.get(student_key)
+        if not student:
+            student = Student(student_key=student_key, student_name=reg.student_name, parent_phone=reg.parent_phone)
+            db.session.add(student)
+            db.session.flush()
+            students[student_key] = student
+        elif not _same_name(student.student_name, reg.student_name):
+            app.logger.warning('舊報名資料未歸戶 (班級座號 %s 已屬於 %s)：%s',
+                               student_key, student.student_name, _describe_registration(reg))
+            continue
+        if (student.id, reg.club_id) in seen:
+            app.logger.warning('刪除重複的舊報名資料：%s', _describe_registration(reg))
+            db.session.delete(reg)
+            continue
+        seen.add((student.id, reg.club_id))
+        reg.student_id = student.id
+    db.session.commit()
+
+def backfill_club_counters():
+    """為尚未有 ClubCounter 的社團建立計數"""
+    club_ids = [club_id for (club_id,) in db.session.query(Club.id).outerjoin(ClubCounter).filter(ClubCounter.club_id.is_(None))]
+    if not club_ids:
+        return
+    counts = count_registrations(club_ids)
+    for club_id in club_ids:
+        db.session.add(ClubCounter(club_id=club_id, regular_count=counts[club_id]["regular"],
+                                   waitlist_count=counts[club_id]["waitlist"]))
+    db.session.commit()
+
+def backfill_event_log():
+    """事件紀錄啟用前的報名資料，補上對應的正取/備取事件"""
+    if RegistrationEvent.query.first() is not None:
+        return
+    rows = []
+    for reg in Registration.query.order_by(Registration.created_at, Registration.id):
+        rows.append({
+            "club_id": reg.club_id,
+            "student_key": reg.student.student_key if reg.student else normalize_student_key(reg.student_class),
+            "event_type": EVENT_ACCEPTED if reg.status == '正取' else EVENT_WAITLISTED,
+            "created_at": reg.created_at,
+        })
+    if rows:
+        db.session.execute(insert(RegistrationEvent), rows)
+        db.session.commit()
+
+@app.cli.command('rebuild-counters')
+def rebuild_counters_command():
+    """由報名事件紀錄重算各社團的正取/備取人數"""
+    rebuild_club_counters()
+    for club in Club.query.order_by(Club.id):
+        click.echo(f"{club.id}\t{club.name}\t正取 {club.current_regular_count()}/{club.max_regular}"
+                   f"\t備取 {club.current_waitlist_count()}/{club.max_waitlist}")
+
+@app.cli.command('replay-events')
+@click.option('--at', 'at', type=click.DateTime(formats=['%Y-%m-%d %H:%M:%S']), default=None, help='重建到此時間點 (台灣時間，格式 YYYY-MM-DD HH:MM:SS)，預設為現在')
+@click.option('--club', 'club_id', type=int, default=None, help='只顯示指定社團')
+def replay_events_command(at, club_id):
+    """重建指定時間點的報名狀態 (處理報名爭議用)"""
+    until = at or get_taiwan_now()
+    state = replay_events(until)
+    names = {club.id: club.name for club in Club.query.all()}
+    for cid in sorted(state):
+        if club_id is not None and cid != club_id:
+            continue
+        club_state = state[cid]
+        click.echo(f"== [{cid}] {names.get(cid, '(已刪除)')} @ {until.strftime('%Y-%m-%d %H:%M:%S')}")
+        click.echo(f"正取 ({len(club_state['regular'])})：{', '.join(k or '?' for k in club_state['regular'])}")
+        click.echo(f"備取 ({len(club_state['waitlist'])})：{', '.join(k or '?' for k in club_state['waitlist'])}")
+        tallies = [f"{event_type}={club_state.get(event_type, 0)}" for event_type in
+                   (EVENT_APPLIED, EVENT_REJECTED_FULL, EVENT_CONFLICT, EVENT_DUPLICATE)]
+        click.echo('事件：' + ' '.join(tallies))
+
 # --- 這裡是最重要的修正！ (Ensure tables are created in production) ---
 with app.app_context():
     db.create_all()
+    upgrade_schema()
+    upgrade_club_autoincrement()
+    backfill_students()
+    backfill_club_counters()
+    backfill_event_log()
     get_system_config()
 
 if __name__ == '__main__':
@@ -0,0 +1,25 @@
+import os
+import sys
+import tempfile
+
+# 測試使用獨立的暫存資料庫，並且不啟動快取預熱排程
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'test.db')
+os.environ['CACHE_WARMUP_ENABLED'] = '0'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import app as app_module
+from app import app as flask_app, db
+
+
+@pytest.fixture
+def app(monkeypatch):
+    # 每個測試都從空的快取與統計開始
+    monkeypatch.setattr(app_module, 'site_cache', app_module.TransitionCache())
+    monkeypatch.setattr(app_module, 'registration_analytics', app_module.RegistrationAnalytics())
+    with flask_app.app_context():
+        db.drop_all()
+        db.create_all()
+        yield flask_app
+        db.session.remove()
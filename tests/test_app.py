@@ -0,0 +1,316 @@
+import logging
+from datetime import datetime, time, timedelta
+
+import pytest
+
+from sqlalchemy import text
+
+import app as app_module
+from app import (ANALYTICS_REFRESH_INTERVAL, CACHE_OPEN_TTL, CACHE_WARMUP_LEAD, Club, ClubCounter, Registration, RegistrationEvent, Student,
+                 TransitionCache, backfill_students, db, normalize_student_key, rebuild_club_counters,
+                 replay_events, upgrade_club_autoincrement, warm_upcoming_transitions)
+
+
+@pytest.mark.parametrize('raw, expected', [
+    ('60105', '60105'),
+    ('６０１０５', '60105'),
+    (' 601-05 ', '60105'),
+    ('6年1班5號', '60105'),
+    ('六年一班五號', '60105'),
+    ('六年十二班二十號', '61220'),
+    ('060105', '60105'),
+    ('6年1班5號(2)', None),
+    ('6-1-5-2', None),
+    ('王小明', None),
+    ('', None),
+])
+def test_normalize_student_key(raw, expected):
+    assert normalize_student_key(raw) == expected
+
+
+def make_club(name, weekday='星期一', max_regular=20, max_waitlist=5, start_time=datetime(2020, 1, 1),
+              class_start=time(15)):
+    club = Club(name=name, start_time=start_time, end_time=datetime(2099, 1, 1), weekday=weekday,
+                class_start=class_start, class_end=time(class_start.hour + 1), max_regular=max_regular,
+                max_waitlist=max_waitlist, counter=ClubCounter())
+    db.session.add(club)
+    db.session.commit()
+    return club
+
+
+def add_legacy_registration(club, student_class, student_name, created_at):
+    reg = Registration(club_id=club.id, student_name=student_name, student_class=student_class,
+                       parent_phone='0912345678', status='正取', created_at=created_at)
+    db.session.add(reg)
+    db.session.commit()
+    return reg
+
+
+def test_backfill_students_links_and_dedupes(app, caplog):
+    club_a = make_club('A')
+    club_b = make_club('B', weekday='星期二')
+    first = add_legacy_registration(club_a, '60105', '王小明', datetime(2024, 1, 1, 8, 0))
+    duplicate = add_legacy_registration(club_a, '６０１０５', '王 小明', datetime(2024, 1, 1, 8, 1))
+    other_club = add_legacy_registration(club_b, '6年1班5號', '王小明', datetime(2024, 1, 1, 8, 2))
+    other_name = add_legacy_registration(club_a, '601-05', '李大華', datetime(2024, 1, 1, 8, 3))
+    unparsable = add_legacy_registration(club_a, '6-1-5-2', '陳小美', datetime(2024, 1, 1, 8, 4))
+    ids = {name: reg.id for name, reg in [('first', first), ('duplicate', duplicate), ('other_club', other_club),
+                                          ('other_name', other_name), ('unparsable', unparsable)]}
+
+    with caplog.at_level(logging.WARNING):
+        backfill_students()
+
+    student = Student.query.filter_by(student_key='60105').one()
+    assert Student.query.count() == 1
+    assert db.session.get(Registration, ids['duplicate']) is None
+    assert db.session.get(Registration, ids['first']).student_id == student.id
+    assert db.session.get(Registration, ids['other_club']).student_id == student.id
+    # 姓名不同或班級座號無法辨識的資料保留下來，不歸戶
+    assert db.session.get(Registration, ids['other_name']).student_id is None
+    assert db.session.get(Registration, ids['unparsable']).student_id is None
+
+    messages = [record.getMessage() for record in caplog.records]
+    assert any('刪除重複' in m and f"#{ids['duplicate']} " in m for m in messages)
+    assert any('未歸戶' in m and f"#{ids['other_name']} " in m for m in messages)
+    assert any('未歸戶' in m and f"#{ids['unparsable']} " in m for m in messages)
+
+
+def test_transition_cache_switches_staged_value_at_boundary():
+    cache = TransitionCache()
+    now = datetime(2024, 1, 1, 8, 0)
+    boundary = now + timedelta(seconds=30)
+    cache.set('k', 'before', boundary, cache.generation('k'))
+    cache.stage('k', 'after', boundary, boundary + timedelta(minutes=5), cache.generation('k'))
+
+    assert cache.get('k', boundary - timedelta(microseconds=1)) == 'before'
+    assert cache.get('k', boundary) == 'after'
+
+
+def test_transition_cache_drops_value_read_before_invalidate():
+    cache = TransitionCache()
+    now = datetime(2024, 1, 1, 8, 0)
+    generation = cache.generation('k')
+    # 讀取資料與寫入快取之間有人報名
+    cache.invalidate('k')
+    cache.stage('k', 'stale', now, now + timedelta(minutes=5), generation)
+    cache.set('k', 'stale', now + timedelta(minutes=5), generation)
+
+    assert not cache.is_staged('k', now)
+    assert cache.get('k', now) is None
+
+
+def register(client, club_id, student_class):
+    return client.post(f'/register/{club_id}', data={
+        'student_name': student_class, 'student_class': student_class, 'parent_phone': '0912345678'})
+
+
+def test_rebuild_counters_matches_registrations(app):
+    club = make_club('A', max_regular=2, max_waitlist=1)
+    client = app.test_client()
+    for student_class in ['60101', '60102', '60103', '60104']:
+        register(client, club.id, student_class)
+
+    # 不等背景執行緒寫入診斷事件，正取/備取事件應已和報名資料一起寫入
+    ClubCounter.query.update({'regular_count': 0, 'waitlist_count': 0})
+    db.session.commit()
+    rebuild_club_counters()
+
+    counter = db.session.get(ClubCounter, club.id)
+    assert counter.regular_count == Registration.query.filter_by(club_id=club.id, status='正取').count() == 2
+    assert counter.waitlist_count == Registration.query.filter_by(club_id=club.id, status='備取').count() == 1
+
+
+def test_deleted_club_id_is_not_reused(app):
+    club = make_club('A')
+    deleted_id = club.id
+    db.session.delete(club)
+    db.session.commit()
+
+    assert make_club('B').id != deleted_id
+
+
+def test_upgrade_club_autoincrement_skips_ids_used_by_events(app):
+    # 模擬舊版 (沒有 AUTOINCREMENT) 的 club 資料表
+    db.session.execute(text('CREATE TABLE club_old AS SELECT * FROM club'))
+    db.session.execute(text('DROP TABLE club'))
+    db.session.execute(text(
+        'CREATE TABLE club (id INTEGER NOT NULL PRIMARY KEY, name VARCHAR(100) NOT NULL, description TEXT, '
+        'image_data TEXT, start_time DATETIME NOT NULL, end_time DATETIME NOT NULL, max_regular INTEGER, '
+        'max_waitlist INTEGER, weekday VARCHAR(10) NOT NULL, class_start TIME NOT NULL, class_end TIME NOT NULL)'))
+    db.session.execute(text('DROP TABLE club_old'))
+    db.session.commit()
+    kept = make_club('A')
+    db.session.add(RegistrationEvent(club_id=7, event_type='accepted', created_at=datetime(2024, 1, 1)))
+    db.session.commit()
+
+    upgrade_club_autoincrement()
+
+    assert 'AUTOINCREMENT' in db.session.execute(
+        text("SELECT sql FROM sqlite_master WHERE name = 'club'")).scalar().upper()
+    assert db.session.get(Club, kept.id).name == 'A'
+    assert make_club('B').id == 8
+
+
+def test_analytics_resets_when_club_is_deleted(app):
+    club = make_club('A', max_regular=1, max_waitlist=0)
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['logged_in'] = True
+    register(client, club.id, '60101')
+    assert client.get('/api/admin/analytics').json['clubs'][0]['accepted'] == 1
+
+    client.get(f'/admin/delete/{club.id}')
+    new_club = make_club('B')
+
+    stats = client.get('/api/admin/analytics').json['clubs']
+    assert [(c['club_id'], c['accepted'], c['full_at']) for c in stats] == [(new_club.id, 0, None)]
+
+
+def register_as(client, club_id, student_class, student_name, parent_phone):
+    return client.post(f'/register/{club_id}', data={
+        'student_name': student_name, 'student_class': student_class, 'parent_phone': parent_phone})
+
+
+def test_my_registrations_lookup(app):
+    club_a = make_club('A', weekday='星期一')
+    club_b = make_club('B', weekday='星期二')
+    client = app.test_client()
+    register_as(client, club_b.id, '60105', '王小明', '0912345678')
+    register_as(client, club_a.id, '60105', '王小明', '0912345678')
+
+    resp = client.get('/api/my-registrations', query_string={'student_class': '601-05', 'parent_phone': '0912-345-678'})
+    assert resp.status_code == 200
+    assert resp.json['student_key'] == '60105'
+    assert resp.json['student_name'] == '王小明'
+    assert [r['club_name'] for r in resp.json['registrations']] == ['B', 'A']
+
+    page = client.get('/my', query_string={'student_class': '６０１０５', 'parent_phone': '(09)1234-5678'})
+    assert page.text.index('>B</a>') < page.text.index('>A</a>')
+
+    resp = client.get('/api/my-registrations', query_string={'student_class': '60105', 'parent_phone': '0987654321'})
+    assert resp.status_code == 404
+
+
+def test_registration_with_same_key_but_other_name_is_not_merged(app):
+    club_a = make_club('A', weekday='星期一')
+    club_b = make_club('B', weekday='星期二')
+    client = app.test_client()
+    # X 家打錯班級座號，先佔用了 60105
+    register_as(client, club_a.id, '601-05', '林小華', '0911111111')
+    register_as(client, club_b.id, '60105', '王小明', '0922222222')
+    with client.session_transaction() as sess:
+        assert '其他姓名' in sess['_flashes'][-1][1]
+    assert Registration.query.filter_by(club_id=club_b.id).count() == 0
+
+    x_view = client.get('/api/my-registrations', query_string={'student_class': '60105', 'parent_phone': '0911111111'})
+    assert [r['club_name'] for r in x_view.json['registrations']] == ['A']
+    assert client.get('/api/my-registrations', query_string={
+        'student_class': '60105', 'parent_phone': '0922222222'}).status_code == 404
+
+
+def test_my_registrations_only_shows_rows_with_matching_phone(app):
+    club_a = make_club('A', weekday='星期一')
+    club_b = make_club('B', weekday='星期二')
+    client = app.test_client()
+    register_as(client, club_a.id, '60105', '王小明', '0911111111')
+    # 另一位家長以同一個孩子的名字報名，使用不同電話
+    register_as(client, club_b.id, '60105', '王小明', '0922222222')
+
+    resp = client.get('/api/my-registrations', query_string={'student_class': '60105', 'parent_phone': '0922222222'})
+    assert [r['club_name'] for r in resp.json['registrations']] == ['B']
+
+
+def test_warm_upcoming_transitions_stages_seats_and_home_page(app):
+    now = datetime(2024, 1, 1, 7, 59, 50)
+    opening = now + CACHE_WARMUP_LEAD - timedelta(seconds=20)
+    club = make_club('A', start_time=opening)
+    cache = app_module.site_cache
+
+    delay = warm_upcoming_transitions(now)
+
+    assert delay == (opening - now).total_seconds()
+    assert cache.is_staged(('seats', club.id), opening)
+    assert cache.is_staged('page:index', opening)
+    # 開放前不生效，開放當下切換，且報名期間最多只保留 CACHE_OPEN_TTL
+    cache.get(('seats', club.id), opening - timedelta(microseconds=1))
+    cache.get('page:index', opening - timedelta(microseconds=1))
+    assert cache.is_staged(('seats', club.id), opening)
+    assert cache.is_staged('page:index', opening)
+    assert cache.get(('seats', club.id), opening) == {'regular': 0, 'waitlist': 0}
+    assert cache.get('page:index', opening) is not None
+    assert not cache.is_staged(('seats', club.id), opening)
+    assert not cache.is_staged('page:index', opening)
+    assert cache.get(('seats', club.id), opening + CACHE_OPEN_TTL) is None
+    assert cache.get('page:index', opening + CACHE_OPEN_TTL) is None
+
+
+def add_event(club_id, event_type, student_key, created_at):
+    db.session.add(RegistrationEvent(club_id=club_id, event_type=event_type, student_key=student_key,
+                                     created_at=created_at))
+
+
+def test_replay_events_reconstructs_state_at_timestamp(app):
+    opening = datetime(2024, 1, 1, 8, 0)
+    # 事件 id 的順序與發生時間不同 (背景批次寫入較晚)，重建時應依 created_at 排序
+    add_event(1, 'accepted', '60102', opening + timedelta(seconds=2))
+    add_event(1, 'accepted', '60101', opening + timedelta(seconds=1))
+    add_event(1, 'waitlisted', '60104', opening + timedelta(seconds=4))
+    add_event(1, 'waitlisted', '60103', opening + timedelta(seconds=3))
+    add_event(1, 'rejected_full', '60105', opening + timedelta(seconds=5))
+    add_event(1, 'accepted', '60106', opening + timedelta(seconds=10))
+    db.session.commit()
+
+    state = replay_events(until=opening + timedelta(seconds=5))
+
+    assert state[1]['regular'] == ['60101', '60102']
+    assert state[1]['waitlist'] == ['60103', '60104']
+    assert state[1]['rejected_full'] == 1
+    assert 1 not in replay_events(until=opening)
+    assert replay_events()[1]['regular'] == ['60101', '60102', '60106']
+
+
+def test_replay_events_command_rejects_malformed_timestamp(app):
+    result = app.test_cli_runner().invoke(args=['replay-events', '--at', '2024/01/01'])
+
+    assert result.exit_code == 2
+    assert 'Invalid value for' in result.output
+
+
+def test_analytics_folds_events_across_refreshes(app):
+    opening = datetime(2024, 1, 1, 8, 0)
+    club_a = make_club('A', weekday='星期五', max_regular=2, max_waitlist=1, start_time=opening)
+    club_b = make_club('B', weekday='星期四', max_regular=3, max_waitlist=0, start_time=opening, class_start=time(9))
+    analytics = app_module.registration_analytics
+
+    add_event(club_a.id, 'applied', '60101', opening + timedelta(seconds=5))
+    add_event(club_a.id, 'accepted', '60101', opening + timedelta(seconds=5))
+    add_event(club_b.id, 'applied', '60101', opening + timedelta(seconds=6))
+    db.session.commit()
+    first = analytics.get(opening + timedelta(minutes=1))
+    stats = {c['club_id']: c for c in first['clubs']}
+    assert stats[club_a.id]['fill_rate'] == 0.5
+    assert stats[club_a.id]['time_to_full_seconds'] is None
+
+    # 第二批事件中 A 社正取額滿
+    for student_key, offset in [('60102', 30), ('60103', 31), ('60104', 40)]:
+        add_event(club_a.id, 'applied', student_key, opening + timedelta(seconds=offset))
+    add_event(club_a.id, 'accepted', '60102', opening + timedelta(seconds=30))
+    add_event(club_a.id, 'waitlisted', '60103', opening + timedelta(seconds=31))
+    add_event(club_a.id, 'rejected_full', '60104', opening + timedelta(seconds=40))
+    add_event(club_b.id, 'accepted', '60101', opening + timedelta(seconds=50))
+    db.session.commit()
+    second = analytics.get(opening + timedelta(minutes=1) + ANALYTICS_REFRESH_INTERVAL)
+
+    assert [c['club_id'] for c in second['clubs']] == [club_a.id, club_b.id]
+    a, b = second['clubs']
+    assert (a['applied'], a['accepted'], a['fill_rate'], a['time_to_full_seconds'],
+            a['waitlist_depth'], a['rejected_full']) == (4, 2, 1.0, 30.0, 1, 1)
+    assert a['full_at'] == '2024-01-01 08:00:30'
+    assert (b['accepted'], b['fill_rate'], b['time_to_full_seconds']) == (1, 0.333, None)
+    # 需求依星期排序 (星期四在星期五之前)
+    assert second['demand'] == [
+        {'weekday': '星期四', 'time_slot': '09:00', 'clubs': 1, 'capacity': 3, 'applied': 1, 'accepted': 1,
+         'waitlisted': 0, 'rejected_full': 0, 'demand_ratio': 0.33},
+        {'weekday': '星期五', 'time_slot': '15:00', 'clubs': 1, 'capacity': 3, 'applied': 4, 'accepted': 2,
+         'waitlisted': 1, 'rejected_full': 1, 'demand_ratio': 1.33},
+    ]